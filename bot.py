@@ -2,18 +2,23 @@
 
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
 )
+from telegram.request import HTTPXRequest
 
-from game import Cell, Player, TicTacToe, SYMBOLS
+from game import Cell, Player, TicTacToe, SYMBOLS, cell_bit, cell_from_masks
+from storage import StoreBusy, create_store
 
 load_dotenv()
 
@@ -23,78 +28,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Store active games: key = chat_id, value = TicTacToe instance
-games: dict[int, TicTacToe] = {}
+# Active games, one per chat (in memory, or in Redis when REDIS_URL is set)
+store = create_store(os.getenv("REDIS_URL"))
+
+
+# ─── Static keyboards ──────────────────────────────────────
+# Keyboards that never depend on game state are built once and shared.
+#
+# callback_data is kept to one kind character plus an optional cell index
+# (row * 3 + col): "m4" = move, "n4" = no-op, "w" = waiting, "j" = join,
+# "p" = play again.
+
+_JOIN_ROW = (InlineKeyboardButton("Join as ⭕", callback_data="j"),)
+_PLAY_AGAIN_ROW = (InlineKeyboardButton("Play Again", callback_data="p"),)
+
+_JOIN_MARKUP = InlineKeyboardMarkup([_JOIN_ROW])
+_PLAY_AGAIN_MARKUP = InlineKeyboardMarkup([_PLAY_AGAIN_ROW])
+_WAIT_MARKUP = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(SYMBOLS[Cell.EMPTY], callback_data="w") for _ in range(3)]
+        for _ in range(3)
+    ]
+    + [_JOIN_ROW]
+)
 
 
 # ─── Helpers ────────────────────────────────────────────────
 
 
+@lru_cache(maxsize=4096)
+def _display_name(user_id: int, username: str | None, first_name: str) -> str:
+    """Build (and cache) a display name; names are part of the key, so renames miss."""
+    if username:
+        return f"@{username}"
+    return first_name
+
+
 def get_display_name(user) -> str:
     """Get a readable display name for a Telegram user."""
-    if user.username:
-        return f"@{user.username}"
-    return user.first_name
+    return _display_name(user.id, user.username, user.first_name)
 
 
-def build_board_keyboard(game: TicTacToe, game_over: bool = False) -> InlineKeyboardMarkup:
-    """Build a 3x3 InlineKeyboard representing the board."""
+@lru_cache(maxsize=65536)
+def _board_markup(
+    x_mask: int, o_mask: int, game_over: bool, play_again: bool = False
+) -> InlineKeyboardMarkup:
+    """Build (and cache) the board keyboard for a given position.
+
+    Markups are only ever sent to Telegram, never mutated, so one instance
+    can be shared by every chat that reaches the same position.
+    """
     keyboard = []
     for row in range(3):
         row_buttons = []
         for col in range(3):
-            cell = game.board[row][col]
+            cell = cell_from_masks(x_mask, o_mask, cell_bit(row, col))
             text = SYMBOLS[cell]
             # If game over or cell taken, callback is a no-op
             if game_over or cell != Cell.EMPTY:
-                callback_data = f"noop_{row}_{col}"
+                callback_data = f"n{row * 3 + col}"
             else:
-                callback_data = f"move_{row}_{col}"
+                callback_data = f"m{row * 3 + col}"
             row_buttons.append(InlineKeyboardButton(text, callback_data=callback_data))
         keyboard.append(row_buttons)
+    if play_again:
+        keyboard.append(_PLAY_AGAIN_ROW)
     return InlineKeyboardMarkup(keyboard)
 
 
+def build_board_keyboard(game: TicTacToe, game_over: bool = False) -> InlineKeyboardMarkup:
+    """Build a 3x3 InlineKeyboard representing the board."""
+    return _board_markup(game.x_mask, game.o_mask, game_over)
+
+
 def build_join_keyboard() -> InlineKeyboardMarkup:
     """Build the 'Join as O' button (shown below the board in group chats)."""
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Join as ⭕", callback_data="join_o")]
-    ])
+    return _JOIN_MARKUP
 
 
 def build_board_with_join(game: TicTacToe) -> InlineKeyboardMarkup:
     """Board grid + join button at the bottom (for waiting state in groups)."""
-    keyboard = []
-    for row in range(3):
-        row_buttons = []
-        for col in range(3):
-            text = SYMBOLS[Cell.EMPTY]
-            callback_data = f"wait_{row}_{col}"
-            row_buttons.append(InlineKeyboardButton(text, callback_data=callback_data))
-        keyboard.append(row_buttons)
-    # Add join button as last row
-    keyboard.append([InlineKeyboardButton("Join as ⭕", callback_data="join_o")])
-    return InlineKeyboardMarkup(keyboard)
+    # The waiting board is always empty, so the same markup serves every game
+    return _WAIT_MARKUP
 
 
 def build_play_again_keyboard() -> InlineKeyboardMarkup:
     """Build the 'Play Again' button."""
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Play Again", callback_data="play_again")]
-    ])
+    return _PLAY_AGAIN_MARKUP
 
 
 def build_game_over_keyboard(game: TicTacToe) -> InlineKeyboardMarkup:
     """Board (disabled) + Play Again button."""
-    keyboard = []
-    for row in range(3):
-        row_buttons = []
-        for col in range(3):
-            text = SYMBOLS[game.board[row][col]]
-            row_buttons.append(InlineKeyboardButton(text, callback_data=f"noop_{row}_{col}"))
-        keyboard.append(row_buttons)
-    keyboard.append([InlineKeyboardButton("Play Again", callback_data="play_again")])
-    return InlineKeyboardMarkup(keyboard)
+    return _board_markup(game.x_mask, game.o_mask, True, play_again=True)
+
+
+# Fixed parts of the status text, indexed by Cell value
+_WIN_PREFIX = tuple(f"🏆 {symbol} " for symbol in SYMBOLS)
+_TURN_PREFIX = tuple(f"Tic-Tac-Toe\n\n{symbol} " for symbol in SYMBOLS)
 
 
 def status_text(game: TicTacToe) -> str:
@@ -102,18 +132,62 @@ def status_text(game: TicTacToe) -> str:
     if game.game_over:
         winner = game.get_winner_player()
         if winner:
-            symbol = SYMBOLS[winner.symbol]
-            return f"🏆 {symbol} {winner.username} wins!"
-        else:
-            return "🤝 It's a draw!"
+            return _WIN_PREFIX[winner.symbol] + winner.username + " wins!"
+        return "🤝 It's a draw!"
 
     current = game.get_current_player()
     if current:
-        symbol = SYMBOLS[current.symbol]
-        return f"Tic-Tac-Toe\n\n{symbol} {current.username}'s turn"
+        return _TURN_PREFIX[current.symbol] + current.username + "'s turn"
     return "Tic-Tac-Toe\n\nWaiting for opponent..."
 
 
+def render_key(query, game: TicTacToe, text: str) -> tuple:
+    """Identify what a message shows; text and masks determine the keyboard."""
+    return (query.message.message_id, text, game.x_mask, game.o_mask)
+
+
+async def edit_board(query, text: str, keyboard: InlineKeyboardMarkup) -> None:
+    """Edit the game message, ignoring 'not modified' from duplicate callbacks."""
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # A duplicate callback may already have applied this exact edit
+        if "message is not modified" not in str(e).lower():
+            raise
+
+
+async def show_board(
+    update: Update,
+    game: TicTacToe,
+    text: str,
+    keyboard: InlineKeyboardMarkup,
+    answer_text: str | None = None,
+) -> None:
+    """Save the game, then answer the callback and edit the message.
+
+    The edit is skipped if the message already shows this board.
+    """
+    query = update.callback_query
+    chat_id = update.effective_chat.id
+    render = render_key(query, game, text)
+    if game.last_render == render:
+        await store.save_game(chat_id, game)
+        await query.answer(answer_text)
+        return
+
+    # Save first, so a slow or failed edit can't leave the store behind the board
+    game.last_render = render
+    await store.save_game(chat_id, game)
+    try:
+        # Clear the button spinner and edit the message concurrently
+        await asyncio.gather(query.answer(answer_text), edit_board(query, text, keyboard))
+    except Exception:
+        # The edit may not have landed; don't let it suppress the next one
+        game.last_render = None
+        await store.save_game(chat_id, game)
+        raise
+
+
 # ─── Command Handler ────────────────────────────────────────
 
 
@@ -139,21 +213,25 @@ async def tictactoe_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             symbol=Cell.O,
         )
         game.is_vs_bot = True
-        games[chat_id] = game
-
         text = status_text(game)
         keyboard = build_board_keyboard(game)
-        await update.message.reply_text(text, reply_markup=keyboard)
     else:
         # In group chat, wait for another player to join
-        games[chat_id] = game
         text = (
             f"Tic-Tac-Toe\n\n"
             f"❌ {game.player_x.username} wants to play!\n"
             f"Tap 'Join as ⭕' to start the game."
         )
         keyboard = build_board_with_join(game)
-        await update.message.reply_text(text, reply_markup=keyboard)
+
+    # Store the game before its board is shown, so the first tap finds it
+    try:
+        async with store.lock(chat_id):
+            await store.save_game(chat_id, game)
+    except StoreBusy:
+        await update.message.reply_text("Busy, try again.")
+        return
+    await update.message.reply_text(text, reply_markup=keyboard)
 
 
 # ─── Callback Query Handler ─────────────────────────────────
@@ -163,142 +241,165 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Handle all inline keyboard button presses."""
     query = update.callback_query
     chat_id = update.effective_chat.id
-    user = query.from_user
     data = query.data
+    kind = data[:1]
 
-    # ── Play Again ──
-    if data == "play_again":
-        await query.answer()
-        # Start a new game with this user as X
-        game = TicTacToe()
-        game.player_x = Player(
-            user_id=user.id,
-            username=get_display_name(user),
-            symbol=Cell.X,
-        )
-        is_private = update.effective_chat.type == "private"
-
-        if is_private:
-            game.player_o = Player(
-                user_id=0,
-                username="Bot 🤖",
-                symbol=Cell.O,
-            )
-            game.is_vs_bot = True
-            games[chat_id] = game
-            text = status_text(game)
-            keyboard = build_board_keyboard(game)
-        else:
-            games[chat_id] = game
-            text = (
-                f"Tic-Tac-Toe\n\n"
-                f"❌ {game.player_x.username} wants to play!\n"
-                f"Tap 'Join as ⭕' to start the game."
-            )
-            keyboard = build_board_with_join(game)
+    # ── Waiting cells (before player O joins) ──
+    # These answers never change for the same button, so let clients cache
+    # them instead of calling the bot again on repeat taps
+    if kind == "w":
+        await query.answer("Waiting for an opponent to join...", show_alert=True, cache_time=30)
+        return
 
-        await query.edit_message_text(text, reply_markup=keyboard)
+    handler = GAME_HANDLERS.get(kind)
+    # Moves are "m0".."m8"; anything else (e.g. a pre-"m4" "move_1_1") is stale
+    if kind == "m" and not (len(data) == 2 and "0" <= data[1] <= "8"):
+        handler = None
+    # ── No-op cells (game over or already taken), or unknown buttons ──
+    if handler is None:
+        await query.answer(cache_time=300)
         return
 
-    # ── Join as O ──
-    if data == "join_o":
-        game = games.get(chat_id)
-        if not game:
-            await query.answer("No active game. Use /tictactoe to start one.", show_alert=True)
-            return
-        if game.player_o is not None:
-            await query.answer("Game already has two players!", show_alert=True)
-            return
-        if user.id == game.player_x.user_id:
-            await query.answer("You can't play against yourself! Ask someone else to join.", show_alert=True)
-            return
+    # Everything below reads and updates the chat's game
+    try:
+        async with store.lock(chat_id):
+            game = await store.load_game(chat_id)
+            await handler(update, game, data)
+    except StoreBusy:
+        await query.answer("Busy, try again.")
+
 
-        # Register player O
+async def handle_play_again(update: Update, game: TicTacToe | None, data: str) -> None:
+    """Start a new game with this user as X, replacing the finished one."""
+    query = update.callback_query
+    user = query.from_user
+    is_private = update.effective_chat.type == "private"
+
+    # Carry over what the message shows, so a repeat tap skips the edit
+    last_render = game.last_render if game else None
+    game = TicTacToe(last_render=last_render)
+    game.player_x = Player(
+        user_id=user.id,
+        username=get_display_name(user),
+        symbol=Cell.X,
+    )
+
+    if is_private:
         game.player_o = Player(
-            user_id=user.id,
-            username=get_display_name(user),
+            user_id=0,
+            username="Bot 🤖",
             symbol=Cell.O,
         )
-        await query.answer(f"You joined as ⭕!")
-
+        game.is_vs_bot = True
         text = status_text(game)
         keyboard = build_board_keyboard(game)
-        await query.edit_message_text(text, reply_markup=keyboard)
-        return
+    else:
+        text = (
+            f"Tic-Tac-Toe\n\n"
+            f"❌ {game.player_x.username} wants to play!\n"
+            f"Tap 'Join as ⭕' to start the game."
+        )
+        keyboard = build_board_with_join(game)
 
-    # ── Waiting cells (before player O joins) ──
-    if data.startswith("wait_"):
-        await query.answer("Waiting for an opponent to join...", show_alert=True)
-        return
+    await show_board(update, game, text, keyboard)
 
-    # ── No-op cells (game over or already taken) ──
-    if data.startswith("noop_"):
-        await query.answer()
-        return
 
-    # ── Move ──
-    if data.startswith("move_"):
-        game = games.get(chat_id)
-        if not game:
-            await query.answer("No active game. Use /tictactoe to start one.", show_alert=True)
+async def handle_join(update: Update, game: TicTacToe | None, data: str) -> None:
+    """Register the user as player O."""
+    query = update.callback_query
+    user = query.from_user
+    if not game:
+        await query.answer("No active game. Use /tictactoe to start one.", show_alert=True)
+        return
+    if game.player_o is not None:
+        # A repeat tap by the player who just joined is answered silently
+        if user.id == game.player_o.user_id and game.last_render == render_key(query, game, status_text(game)):
+            await query.answer()
             return
+        await query.answer("Game already has two players!", show_alert=True)
+        return
+    if user.id == game.player_x.user_id:
+        await query.answer("You can't play against yourself! Ask someone else to join.", show_alert=True)
+        return
 
-        if game.player_o is None:
-            await query.answer("Waiting for an opponent to join...", show_alert=True)
-            return
+    # Register player O
+    game.player_o = Player(
+        user_id=user.id,
+        username=get_display_name(user),
+        symbol=Cell.O,
+    )
+    text = status_text(game)
+    keyboard = build_board_keyboard(game)
+    await show_board(update, game, text, keyboard, "You joined as ⭕!")
 
-        _, row_str, col_str = data.split("_")
-        row, col = int(row_str), int(col_str)
 
-        # Determine which cell this user should place
-        if user.id == game.player_x.user_id:
-            player_cell = Cell.X
-        elif user.id == game.player_o.user_id:
-            player_cell = Cell.O
-        else:
-            await query.answer("You're not in this game!", show_alert=True)
-            return
+async def handle_move(update: Update, game: TicTacToe | None, data: str) -> None:
+    """Apply a player's move (and the bot's reply in private chat)."""
+    query = update.callback_query
+    user = query.from_user
+    if not game:
+        await query.answer("No active game. Use /tictactoe to start one.", show_alert=True)
+        return
 
-        # Validate it's this player's turn
-        if player_cell != game.current_turn:
-            await query.answer("Not your turn!", show_alert=True)
-            return
+    if game.player_o is None:
+        await query.answer("Waiting for an opponent to join...", show_alert=True)
+        return
 
-        # Make the move
-        if not game.make_move(row, col, player_cell):
-            await query.answer("Invalid move!", show_alert=True)
-            return
+    row, col = divmod(int(data[1]), 3)
 
-        await query.answer()
+    # Determine which cell this user should place
+    if user.id == game.player_x.user_id:
+        player_cell = Cell.X
+    elif user.id == game.player_o.user_id:
+        player_cell = Cell.O
+    else:
+        await query.answer("You're not in this game!", show_alert=True)
+        return
 
-        # If game over, show result
-        if game.game_over:
-            text = status_text(game)
-            keyboard = build_game_over_keyboard(game)
-            await query.edit_message_text(text, reply_markup=keyboard)
-            return
+    # A player's repeat tap on a cell this message already shows as taken is a
+    # duplicate callback; answer it silently (before the turn check)
+    if (game.x_mask | game.o_mask) & cell_bit(row, col) and game.last_render == render_key(
+        query, game, status_text(game)
+    ):
+        await query.answer()
+        return
 
-        # Bot's turn (private chat)
-        if game.is_vs_bot and game.current_turn == Cell.O:
-            bot_pos = game.bot_move()
-            if bot_pos:
-                game.make_move(bot_pos[0], bot_pos[1], Cell.O)
+    # Validate it's this player's turn
+    if player_cell != game.current_turn:
+        await query.answer("Not your turn!", show_alert=True)
+        return
 
-            if game.game_over:
-                text = status_text(game)
-                keyboard = build_game_over_keyboard(game)
-                await query.edit_message_text(text, reply_markup=keyboard)
-                return
+    # Make the move (and the bot's reply, in private chat)
+    if not game.apply_player_move(row, col, player_cell):
+        await query.answer("Invalid move!", show_alert=True)
+        return
 
-        # Update board
-        text = status_text(game)
+    # Update board, or show the result if the game is over
+    text = status_text(game)
+    if game.game_over:
+        keyboard = build_game_over_keyboard(game)
+    else:
         keyboard = build_board_keyboard(game)
-        await query.edit_message_text(text, reply_markup=keyboard)
+    await show_board(update, game, text, keyboard)
+
+
+# Handlers that touch game state, keyed by callback_data kind. They run under
+# the chat's lock and save any change before calling Telegram.
+GAME_HANDLERS = {
+    "p": handle_play_again,
+    "j": handle_join,
+    "m": handle_move,
+}
 
 
 # ─── Main ───────────────────────────────────────────────────
 
 
+async def post_init(app: Application) -> None:
+    """Publish the command list so clients offer /tictactoe in every chat."""
+    await app.bot.set_my_commands([BotCommand("tictactoe", "Start a game")])
+
+
 def main() -> None:
     """Start the bot."""
     token = os.getenv("BOT_TOKEN")
@@ -306,14 +407,40 @@ def main() -> None:
         logger.error("BOT_TOKEN not found! Set it in .env file.")
         return
 
-    app = Application.builder().token(token).build()
+    # Many games edit messages at once; a bigger pool over HTTP/2 keeps
+    # those API calls from queueing behind each other. storage.LOCK_TIMEOUT
+    # must stay above the sum of these timeouts.
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        http_version="2",
+        connect_timeout=5,
+        read_timeout=10,
+        write_timeout=10,
+        pool_timeout=1,
+    )
+    app = Application.builder().token(token).request(request).post_init(post_init).build()
 
     # Register handlers
     app.add_handler(CommandHandler("tictactoe", tictactoe_command))
     app.add_handler(CallbackQueryHandler(callback_handler))
 
-    logger.info("Bot is starting...")
-    app.run_polling(allowed_updates=["message", "callback_query"])
+    # Only the update types we handle; commands arrive as messages
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    public_url = os.getenv("PUBLIC_URL")
+    if public_url:
+        # Telegram pushes updates to us; several workers can share the URL
+        logger.info("Bot is starting (webhook)...")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8080")),
+            url_path=token,
+            webhook_url=f"{public_url.rstrip('/')}/{token}",
+            allowed_updates=allowed_updates,
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+        )
+    else:
+        logger.info("Bot is starting (polling)...")
+        app.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":
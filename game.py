@@ -3,69 +3,220 @@
 from __future__ import annotations
 
 import random
-from dataclasses import dataclass, field
-from enum import Enum
-from typing import Optional, Tuple
+from dataclasses import dataclass
+from typing import Iterator, NamedTuple, Optional, Tuple
 
 
-class Cell(Enum):
+class Cell:
+    """Cell values. Plain ints (not an Enum) so compares stay cheap."""
+
     EMPTY = 0
     X = 1
     O = 2
 
 
-# Display symbols
-SYMBOLS = {
-    Cell.EMPTY: "·",
-    Cell.X: "❌",
-    Cell.O: "⭕",
-}
+# Display symbols, indexed by Cell value
+SYMBOLS = ("·", "❌", "⭕")
+
+# The board is stored as two 9-bit masks, one per player.
+# Cell (row, col) maps to bit 1 << (row * 3 + col).
+FULL_MASK = 0x1FF
 
-# All winning lines: rows, columns, diagonals (indices into the 3x3 board)
-WIN_LINES = [
+# All winning lines as bitmasks: rows, columns, diagonals
+WIN_MASKS = (
     # Rows
-    [(0, 0), (0, 1), (0, 2)],
-    [(1, 0), (1, 1), (1, 2)],
-    [(2, 0), (2, 1), (2, 2)],
+    0b000_000_111,
+    0b000_111_000,
+    0b111_000_000,
     # Columns
-    [(0, 0), (1, 0), (2, 0)],
-    [(0, 1), (1, 1), (2, 1)],
-    [(0, 2), (1, 2), (2, 2)],
+    0b001_001_001,
+    0b010_010_010,
+    0b100_100_100,
     # Diagonals
-    [(0, 0), (1, 1), (2, 2)],
-    [(0, 2), (1, 1), (2, 0)],
-]
+    0b100_010_001,
+    0b001_010_100,
+)
+
+# For each of the 512 possible masks, whether it contains a winning line
+_HAS_LINE = tuple(
+    any(mask & wm == wm for wm in WIN_MASKS) for mask in range(FULL_MASK + 1)
+)
+
+
+def cell_bit(row: int, col: int) -> int:
+    """Return the bitmask for the cell at (row, col)."""
+    return 1 << (row * 3 + col)
+
+
+def cell_from_masks(x_mask: int, o_mask: int, bit: int) -> int:
+    """Return the Cell value at bit, given both players' masks."""
+    if x_mask & bit:
+        return Cell.X
+    if o_mask & bit:
+        return Cell.O
+    return Cell.EMPTY
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """Yield each set bit of mask as a single-bit mask, lowest first."""
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+def iter_empty(occupied: int) -> Iterator[int]:
+    """Yield the bit of each empty cell given the occupied-cells mask."""
+    return iter_bits(FULL_MASK & ~occupied)
+
+
+def has_line(mask: int) -> bool:
+    """Check if mask contains a complete winning line."""
+    return _HAS_LINE[mask]
+
+
+def _build_bot_table() -> dict[Tuple[int, int], int]:
+    """Solve the game once with negamax.
+
+    Returns a table mapping every reachable (x_mask, o_mask) position with
+    O to move to the bitmask of O's optimal moves there.
+    """
+    scores: dict[Tuple[int, int], int] = {}
+    best_moves: dict[Tuple[int, int], int] = {}
+
+    def negamax(me: int, opp: int) -> int:
+        # Score for the side to move; quicker wins (and slower losses) score higher
+        key = (me, opp)
+        if key in scores:
+            return scores[key]
+        best_score = -10
+        best = 0
+        occupied = me | opp
+        # Cells still empty after this move; a win with more left scores higher
+        remaining = 8 - occupied.bit_count()
+        for bit in iter_empty(occupied):
+            mine = me | bit
+            if has_line(mine):
+                score = 1 + remaining
+            elif remaining == 0:
+                score = 0
+            else:
+                score = -negamax(opp, mine)
+            if score > best_score:
+                best_score, best = score, bit
+            elif score == best_score:
+                best |= bit
+        scores[key] = best_score
+        best_moves[key] = best
+        return best_score
 
+    negamax(0, 0)
+    # O has made one fewer move than X whenever it is O's turn
+    return {
+        (opp, me): moves
+        for (me, opp), moves in best_moves.items()
+        if me.bit_count() < opp.bit_count()
+    }
 
-@dataclass
-class Player:
+
+# Optimal bot replies: (x_mask, o_mask) -> bitmask of best moves for O
+_BOT_TABLE = _build_bot_table()
+
+
+class Player(NamedTuple):
     user_id: int
     username: str  # display name (first_name or @username)
-    symbol: Cell  # Cell.X or Cell.O
+    symbol: int  # Cell.X or Cell.O
 
 
-@dataclass
+@dataclass(slots=True)
 class TicTacToe:
     """A single tic-tac-toe game instance."""
 
-    board: list = field(default_factory=lambda: [[Cell.EMPTY] * 3 for _ in range(3)])
+    x_mask: int = 0  # cells taken by X
+    o_mask: int = 0  # cells taken by O
     player_x: Optional[Player] = None
     player_o: Optional[Player] = None
-    current_turn: Cell = Cell.X  # X always goes first
+    current_turn: int = Cell.X  # X always goes first
     is_vs_bot: bool = False  # True when playing against the bot in private chat
     game_over: bool = False
-    winner: Optional[Cell] = None  # None = draw or ongoing, Cell.X/O = winner
+    winner: Optional[int] = None  # None = draw or ongoing, Cell.X/O = winner
+    last_render: Optional[tuple] = None  # last (message_id, text, x_mask, o_mask) sent to the chat
+
+    def to_state(self) -> list:
+        """Flatten the game into plain values (for serialization)."""
+        return [
+            self.x_mask,
+            self.o_mask,
+            self.current_turn,
+            self.game_over,
+            self.winner,
+            self.player_x.user_id if self.player_x else None,
+            self.player_x.username if self.player_x else None,
+            self.player_o.user_id if self.player_o else None,
+            self.player_o.username if self.player_o else None,
+            self.is_vs_bot,
+            list(self.last_render) if self.last_render else None,
+        ]
+
+    @classmethod
+    def from_state(cls, state: list) -> TicTacToe:
+        """Rebuild a game from the output of to_state()."""
+        (
+            x_mask, o_mask, turn, game_over, winner,
+            x_id, x_name, o_id, o_name, is_vs_bot, last_render,
+        ) = state
+        return cls(
+            x_mask=x_mask,
+            o_mask=o_mask,
+            player_x=Player(x_id, x_name, Cell.X) if x_id is not None else None,
+            player_o=Player(o_id, o_name, Cell.O) if o_id is not None else None,
+            current_turn=turn,
+            is_vs_bot=is_vs_bot,
+            game_over=game_over,
+            winner=winner,
+            last_render=tuple(last_render) if last_render else None,
+        )
 
-    def make_move(self, row: int, col: int, player_cell: Cell) -> bool:
+    @property
+    def board(self) -> list:
+        """The board as a 3x3 list of Cells (rebuilt from the masks)."""
+        return [[self.cell_at(row, col) for col in range(3)] for row in range(3)]
+
+    def cell_at(self, row: int, col: int) -> int:
+        """Return the Cell at (row, col)."""
+        return cell_from_masks(self.x_mask, self.o_mask, cell_bit(row, col))
+
+    def make_move(self, row: int, col: int, player_cell: int) -> bool:
         """Place a mark on the board. Returns True if the move was valid."""
         if self.game_over:
             return False
-        if self.board[row][col] != Cell.EMPTY:
+        bit = cell_bit(row, col)
+        if (self.x_mask | self.o_mask) & bit:
             return False
         if player_cell != self.current_turn:
             return False
 
-        self.board[row][col] = player_cell
+        self._place(bit, player_cell)
+        return True
+
+    def apply_player_move(self, row: int, col: int, player_cell: int) -> bool:
+        """Make a player's move and, against the bot, the bot's reply.
+
+        Returns True if the player's move was valid.
+        """
+        if not self.make_move(row, col, player_cell):
+            return False
+        if not self.game_over and self.is_vs_bot and self.current_turn == Cell.O:
+            self._place(self._bot_bit(), Cell.O)
+        return True
+
+    def _place(self, bit: int, player_cell: int) -> None:
+        """Mark an (already validated) cell and update turn/result."""
+        if player_cell == Cell.X:
+            self.x_mask |= bit
+        else:
+            self.o_mask |= bit
         # Check for win or draw
         if self._check_winner(player_cell):
             self.game_over = True
@@ -77,18 +228,17 @@ class TicTacToe:
             # Switch turn
             self.current_turn = Cell.O if self.current_turn == Cell.X else Cell.X
 
-        return True
+    def _mask_for(self, cell: int) -> int:
+        """Return the bitmask of cells taken by the given cell type."""
+        return self.x_mask if cell == Cell.X else self.o_mask
 
-    def _check_winner(self, cell: Cell) -> bool:
+    def _check_winner(self, cell: int) -> bool:
         """Check if the given cell type has three in a row."""
-        for line in WIN_LINES:
-            if all(self.board[r][c] == cell for r, c in line):
-                return True
-        return False
+        return has_line(self._mask_for(cell))
 
     def _check_draw(self) -> bool:
         """Check if all cells are filled (no winner)."""
-        return all(self.board[r][c] != Cell.EMPTY for r in range(3) for c in range(3))
+        return (self.x_mask | self.o_mask) == FULL_MASK
 
     def get_current_player(self) -> Optional[Player]:
         """Return the Player whose turn it is."""
@@ -106,50 +256,12 @@ class TicTacToe:
 
     def get_cell_display(self, row: int, col: int) -> str:
         """Return the display string for a cell."""
-        return SYMBOLS[self.board[row][col]]
-
-    # ─── Simple AI for private-chat mode ───
-
-    def bot_move(self) -> Optional[Tuple[int, int]]:
-        """Compute a move for the bot (playing as O). Returns (row, col) or None."""
-        if self.game_over or self.current_turn != Cell.O:
-            return None
-
-        # 1. Try to win
-        move = self._find_winning_move(Cell.O)
-        if move:
-            return move
-
-        # 2. Block opponent from winning
-        move = self._find_winning_move(Cell.X)
-        if move:
-            return move
-
-        # 3. Take center
-        if self.board[1][1] == Cell.EMPTY:
-            return (1, 1)
-
-        # 4. Take a corner
-        corners = [(0, 0), (0, 2), (2, 0), (2, 2)]
-        random.shuffle(corners)
-        for r, c in corners:
-            if self.board[r][c] == Cell.EMPTY:
-                return (r, c)
-
-        # 5. Take any edge
-        edges = [(0, 1), (1, 0), (1, 2), (2, 1)]
-        random.shuffle(edges)
-        for r, c in edges:
-            if self.board[r][c] == Cell.EMPTY:
-                return (r, c)
+        return SYMBOLS[self.cell_at(row, col)]
 
-        return None
+    # ─── Bot for private-chat mode ───
 
-    def _find_winning_move(self, cell: Cell) -> Optional[Tuple[int, int]]:
-        """Find a move that completes a line of three for the given cell type."""
-        for line in WIN_LINES:
-            cells_in_line = [self.board[r][c] for r, c in line]
-            if cells_in_line.count(cell) == 2 and cells_in_line.count(Cell.EMPTY) == 1:
-                idx = cells_in_line.index(Cell.EMPTY)
-                return line[idx]
-        return None
+    def _bot_bit(self) -> int:
+        """Return the bit of the bot's (O's) next move; O must be to move."""
+        # Pick randomly among the equally good moves so games still vary
+        best = _BOT_TABLE[(self.x_mask, self.o_mask)]
+        return random.choice(list(iter_bits(best)))
@@ -0,0 +1,138 @@
+"""Game state storage.
+
+Games live in process memory by default. Set REDIS_URL to keep them in
+Redis instead, so they survive restarts and can be shared by several bot
+workers.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from game import TicTacToe
+
+logger = logging.getLogger(__name__)
+
+# Idle games expire from Redis after a day
+GAME_TTL = 24 * 60 * 60
+# Seconds before a held Redis chat lock expires. Must outlast the worst case
+# inside it: two Redis calls (REDIS_TIMEOUT each) plus a Bot API answer and
+# edit in parallel (connect 5 + write 10 + read 10 + pool 1 in bot.py).
+LOCK_TIMEOUT = 60
+# Seconds to wait for another handler's chat lock before giving up
+LOCK_WAIT = 5
+# Socket timeout for Redis commands
+REDIS_TIMEOUT = 5
+
+
+class StoreBusy(Exception):
+    """The chat's lock could not be acquired in time."""
+
+
+class ChatLocks:
+    """Per-chat asyncio locks.
+
+    Locks are held weakly, so a chat's lock is dropped once no handler holds
+    or waits on it and the table doesn't grow with every chat ever seen.
+    """
+
+    def __init__(self) -> None:
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def get(self, chat_id: int) -> asyncio.Lock:
+        """Return the lock for the chat, creating it if needed."""
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
+
+
+class MemoryStore:
+    """Keep games in a dict in this process."""
+
+    def __init__(self) -> None:
+        # key = chat_id, value = TicTacToe instance
+        self._games: dict[int, TicTacToe] = {}
+        self._locks = ChatLocks()
+
+    async def load_game(self, chat_id: int) -> Optional[TicTacToe]:
+        """Return the chat's game, or None if there is none."""
+        return self._games.get(chat_id)
+
+    async def save_game(self, chat_id: int, game: TicTacToe) -> None:
+        """Store the chat's game."""
+        self._games[chat_id] = game
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        """Return a lock that serializes updates to the chat's game."""
+        return self._locks.get(chat_id)
+
+
+class RedisStore:
+    """Keep msgpack-encoded games in Redis, keyed by chat_id."""
+
+    def __init__(self, url: str) -> None:
+        import msgpack
+        from redis import asyncio as aioredis
+
+        self._msgpack = msgpack
+        self._redis = aioredis.from_url(url, socket_timeout=REDIS_TIMEOUT)
+        self._local_locks = ChatLocks()
+
+    async def load_game(self, chat_id: int) -> Optional[TicTacToe]:
+        """Return the chat's game, or None if there is none."""
+        raw = await self._redis.get(f"game:{chat_id}")
+        if raw is None:
+            return None
+        return TicTacToe.from_state(self._msgpack.unpackb(raw))
+
+    async def save_game(self, chat_id: int, game: TicTacToe) -> None:
+        """Store the chat's game, refreshing its TTL."""
+        raw = self._msgpack.packb(game.to_state())
+        await self._redis.setex(f"game:{chat_id}", GAME_TTL, raw)
+
+    @asynccontextmanager
+    async def lock(self, chat_id: int) -> AsyncIterator[None]:
+        """Serialize updates to the chat's game across workers.
+
+        Raises StoreBusy if the lock isn't free within LOCK_WAIT seconds.
+        """
+        from redis.exceptions import LockNotOwnedError
+
+        # One deadline covers both the local queue and the Redis lock
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LOCK_WAIT
+
+        # Queue duplicate clicks on this worker locally instead of polling Redis
+        local_lock = self._local_locks.get(chat_id)
+        try:
+            await asyncio.wait_for(local_lock.acquire(), LOCK_WAIT)
+        except asyncio.TimeoutError:
+            raise StoreBusy(chat_id) from None
+        try:
+            lock = self._redis.lock(f"lock:{chat_id}", timeout=LOCK_TIMEOUT)
+            remaining = max(deadline - loop.time(), 0)
+            if not await lock.acquire(blocking_timeout=remaining):
+                raise StoreBusy(chat_id)
+            try:
+                yield
+            finally:
+                try:
+                    await lock.release()
+                except LockNotOwnedError:
+                    # State is saved before any slow call, so only log it
+                    logger.warning("Lock for chat %s expired before release", chat_id)
+        finally:
+            local_lock.release()
+
+
+def create_store(redis_url: Optional[str]) -> MemoryStore | RedisStore:
+    """Use Redis when a URL is configured, otherwise process memory."""
+    if redis_url:
+        return RedisStore(redis_url)
+    return MemoryStore()